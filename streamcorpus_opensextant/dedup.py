@@ -0,0 +1,333 @@
+'''In-chunk deduplication of clean_visible for the OpenSextant tagger.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2014 Diffeo, Inc.
+
+Syndicated news and retweets put many copies of the same text into a
+single chunk.  When the ``opensextant`` stage is configured with a
+positive ``dedup_window``, it remembers the OpenSextant results for
+the most recent distinct bodies in the current input chunk:
+
+* an exact copy, detected by SHA-1 of clean_visible, reuses the
+  earlier result and raw tagging without contacting the service;
+
+* a near copy, detected by comparing bottom-k MinHash sketches of
+  word shingles, reuses the earlier annotations that fall in runs of
+  words the two texts share, and sends only the changed words to
+  the service.  Diffing by word rather than by line means that a
+  retweet, which only adds a prefix to a one-line post, sends just
+  that prefix.
+
+The window is bounded both by number of entries and by the total
+size of the cached bodies and raw taggings.
+
+.. autoclass:: DedupCache
+.. autofunction:: sketch
+.. autofunction:: similarity
+.. autofunction:: band_keys
+.. autofunction:: diff_tokens
+.. autofunction:: shift_annotations
+.. autofunction:: join_regions
+.. autofunction:: unjoin_annotations
+
+'''
+from __future__ import absolute_import
+import bisect
+import collections
+import difflib
+import hashlib
+import heapq
+import logging
+import re
+
+logger = logging.getLogger('streamcorpus_pipeline' + '.' + __name__)
+
+
+## one remembered body: `data` is the UTF-8 clean_visible, `result`
+## the decoded OpenSextant JSON, `raw_tagging` the bytes to store in
+## the Tagging, and `stream_id` the item it was first tagged for
+Entry = collections.namedtuple(
+    'Entry', ['data', 'sketch', 'result', 'raw_tagging', 'stream_id'])
+
+token_re = re.compile(r'\S+', re.UNICODE)
+
+
+def sketch(data, shingle_size=5, sketch_size=64):
+    '''Bottom-k MinHash sketch of the word shingles of `data`.
+
+    :return: frozenset of the `sketch_size` smallest shingle hashes,
+      empty if `data` has fewer than `shingle_size` words
+
+    '''
+    words = data.split()
+    hashes = set(hash(tuple(words[i:i + shingle_size]))
+                 for i in xrange(len(words) - shingle_size + 1))
+    return frozenset(heapq.nsmallest(sketch_size, hashes))
+
+
+def similarity(sketch1, sketch2, sketch_size=64):
+    '''Estimate the Jaccard similarity of two texts from their sketches.'''
+    if not sketch1 or not sketch2:
+        return 0.0
+    union = heapq.nsmallest(sketch_size, sketch1 | sketch2)
+    both = sum(1 for h in union if h in sketch1 and h in sketch2)
+    return float(both) / len(union)
+
+
+def band_keys(data_sketch, bands=8, rows=2):
+    '''Locality-sensitive hash keys for a sketch from :func:`sketch`.
+
+    The shingle hashes are split into ``bands * rows`` bins by value,
+    and the smallest hash in each bin is a MinHash of the text.  Each
+    band key covers `rows` consecutive bins, so two texts share a
+    band with probability about ``similarity ** rows``.  Bands with
+    every bin empty are left out.
+
+    :return: list of ``(band, key)`` pairs
+
+    '''
+    num_bins = bands * rows
+    bins = [None] * num_bins
+    for h in data_sketch:
+        idx = h % num_bins
+        if bins[idx] is None or h < bins[idx]:
+            bins[idx] = h
+    keys = []
+    for band in xrange(bands):
+        values = tuple(bins[band * rows:(band + 1) * rows])
+        if any(value is not None for value in values):
+            keys.append((band, hash(values)))
+    return keys
+
+
+class DedupCache(object):
+    '''Sliding window of recently tagged bodies.
+
+    Entries are keyed by service URL as well as by content, since
+    the same text sent to a different extractor gives a different
+    result.  At most `window` entries are kept, and the oldest are
+    evicted while the cached bodies and raw taggings add up to more
+    than `max_bytes`.  An entry bigger than `max_bytes` on its own
+    is not kept at all.
+
+    Sketches are indexed by their :func:`band_keys`, so :meth:`near`
+    only compares against entries sharing a band, not the whole
+    window.  Pairs well above the default `threshold` of 0.8 almost
+    always share a band; with a much lower threshold, some pairs
+    just above it will be missed.
+
+    .. automethod:: exact
+    .. automethod:: candidates
+    .. automethod:: near
+    .. automethod:: add
+    .. automethod:: remove
+    .. automethod:: reset
+
+    '''
+    def __init__(self, window, threshold=0.8, shingle_size=5,
+                 sketch_size=64, max_bytes=64 * 2**20, bands=8, rows=2):
+        self.window = window
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.sketch_size = sketch_size
+        self.max_bytes = max_bytes
+        self.bands = bands
+        self.rows = rows
+        self.entries = collections.OrderedDict()
+        self.num_bytes = 0
+        ## band key -> set of entry keys
+        self.buckets = collections.defaultdict(set)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def reset(self):
+        '''Forget everything, as at the start of a new chunk.'''
+        self.entries.clear()
+        self.num_bytes = 0
+        self.buckets.clear()
+
+    def digest(self, data):
+        return hashlib.sha1(data).digest()
+
+    def sketch(self, data):
+        return sketch(data, self.shingle_size, self.sketch_size)
+
+    def exact(self, rest_url, digest):
+        '''Find the :class:`Entry` for an exact copy, or :const:`None`.'''
+        return self.entries.get((rest_url, digest))
+
+    def band_keys(self, data_sketch):
+        return band_keys(data_sketch, self.bands, self.rows)
+
+    def candidates(self, rest_url, data_sketch):
+        '''Find the cached entries for `rest_url` that share a band
+        with `data_sketch`.
+
+        '''
+        keys = set()
+        for band_key in self.band_keys(data_sketch):
+            keys.update(self.buckets.get(band_key, ()))
+        return [self.entries[key] for key in keys if key[0] == rest_url]
+
+    def near(self, rest_url, data_sketch):
+        '''Find the most similar :class:`Entry` at least `threshold`
+        similar to `data_sketch`, or :const:`None`.
+
+        '''
+        best = None
+        best_sim = self.threshold
+        for entry in self.candidates(rest_url, data_sketch):
+            sim = similarity(data_sketch, entry.sketch, self.sketch_size)
+            if sim >= best_sim:
+                best, best_sim = entry, sim
+        return best
+
+    def add(self, rest_url, digest, entry):
+        '''Remember `entry`, evicting the oldest entry if needed.'''
+        key = (rest_url, digest)
+        if key in self.entries:
+            self.remove(key)
+        size = entry_bytes(entry)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = entry
+        self.num_bytes += size
+        for band_key in self.band_keys(entry.sketch):
+            self.buckets[band_key].add(key)
+        while len(self.entries) > self.window or \
+              self.num_bytes > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        '''Forget the entry at `key` and take it out of the index.'''
+        entry = self.entries.pop(key)
+        self.num_bytes -= entry_bytes(entry)
+        for band_key in self.band_keys(entry.sketch):
+            bucket = self.buckets[band_key]
+            bucket.discard(key)
+            if not bucket:
+                del self.buckets[band_key]
+
+
+def entry_bytes(entry):
+    return len(entry.data) + len(entry.raw_tagging)
+
+
+def diff_tokens(old_text, new_text):
+    '''Word-by-word comparison of two unicode texts.
+
+    :return: pair of lists ``(shared, changed)``.  `shared` holds
+      ``(old_start, old_end, delta)`` for each run of identical words,
+      where adding `delta` to an offset in `old_text` gives the same
+      position in `new_text`.  `changed` holds ``(new_start, new_end)``
+      for each run of words in `new_text` not in `old_text`.
+
+    The common leading and trailing words are matched in linear
+    time, so only the words between them go through the quadratic
+    :class:`difflib.SequenceMatcher`.  Prefixes, suffixes and edits
+    in one place cost next to nothing; callers should still bound
+    the size of texts with scattered edits.
+
+    '''
+    old_spans = [m.span() for m in token_re.finditer(old_text)]
+    new_spans = [m.span() for m in token_re.finditer(new_text)]
+    old_words = [old_text[start:end] for start, end in old_spans]
+    new_words = [new_text[start:end] for start, end in new_spans]
+
+    limit = min(len(old_words), len(new_words))
+    prefix = 0
+    while prefix < limit and old_words[prefix] == new_words[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and \
+          old_words[-1 - suffix] == new_words[-1 - suffix]:
+        suffix += 1
+    old_end = len(old_words) - suffix
+    new_end = len(new_words) - suffix
+
+    matcher = difflib.SequenceMatcher(
+        None, old_words[prefix:old_end], new_words[prefix:new_end],
+        autojunk=False)
+    opcodes = [('equal', 0, prefix, 0, prefix)]
+    opcodes.extend((tag, i1 + prefix, i2 + prefix, j1 + prefix, j2 + prefix)
+                   for tag, i1, i2, j1, j2 in matcher.get_opcodes())
+    opcodes.append(('equal', old_end, len(old_words),
+                    new_end, len(new_words)))
+
+    shared = []
+    changed = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal':
+            for k in xrange(i2 - i1):
+                old_start, old_end = old_spans[i1 + k]
+                delta = new_spans[j1 + k][0] - old_start
+                ## extend the run while the spacing between words
+                ## is unchanged, so multi-word annotations survive
+                if k and shared[-1][2] == delta:
+                    shared[-1] = (shared[-1][0], old_end, delta)
+                else:
+                    shared.append((old_start, old_end, delta))
+        elif j2 > j1:
+            changed.append((new_spans[j1][0], new_spans[j2 - 1][1]))
+    return shared, changed
+
+
+def shift_annotations(annos, shared):
+    '''Move annotations lying wholly inside shared runs of words.
+
+    :param list annos: OpenSextant annotations on the old text
+    :param list shared: first value returned by :func:`diff_tokens`
+    :return: copies of the annotations with offsets in the new text
+
+    '''
+    starts = [old_start for old_start, _, _ in shared]
+    moved = []
+    for anno in annos:
+        idx = bisect.bisect_right(starts, anno['start']) - 1
+        if idx < 0:
+            continue
+        old_start, old_end, delta = shared[idx]
+        if anno['end'] <= old_end:
+            moved.append(dict(anno, start=anno['start'] + delta,
+                              end=anno['end'] + delta))
+    return moved
+
+
+def join_regions(text, regions, separator=u'\n\n'):
+    '''Concatenate the `regions` of `text` to send in one request.
+
+    :return: pair ``(joined, segments)``, where `segments` holds
+      ``(joined_start, text_start, length)`` for each region
+
+    '''
+    parts = []
+    segments = []
+    pos = 0
+    for start, end in regions:
+        if parts:
+            parts.append(separator)
+            pos += len(separator)
+        parts.append(text[start:end])
+        segments.append((pos, start, end - start))
+        pos += end - start
+    return u''.join(parts), segments
+
+
+def unjoin_annotations(annos, segments):
+    '''Map annotations on the output of :func:`join_regions` back to
+    the original text, dropping any that straddle two regions.
+
+    '''
+    starts = [joined_start for joined_start, _, _ in segments]
+    moved = []
+    for anno in annos:
+        idx = bisect.bisect_right(starts, anno['start']) - 1
+        if idx < 0:
+            continue
+        joined_start, text_start, length = segments[idx]
+        if anno['end'] <= joined_start + length:
+            delta = text_start - joined_start
+            moved.append(dict(anno, start=anno['start'] + delta,
+                              end=anno['end'] + delta))
+    return moved
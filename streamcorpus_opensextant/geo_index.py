@@ -0,0 +1,205 @@
+'''Per-chunk geospatial sidecar index of OpenSextant place mentions.
+
+.. This software is released under an MIT/X11 open source license.
+   Copyright 2014 Diffeo, Inc.
+
+When the ``opensextant`` stage is configured with ``geo_index_dir``,
+it collects the coordinates of resolved ``Geo.*`` mentions while it
+aligns each stream item, and writes one small sidecar file per input
+chunk.  The sidecar is created, empty, as soon as the first item of a
+chunk arrives, and each item's places are appended and flushed as
+soon as that item is tagged, so the sidecar is complete for every
+item that has left the stage.  A chunk with no places therefore has
+a sidecar with no points, while a chunk that was never indexed has no
+sidecar at all.
+
+The file is JSON lines: a header object giving ``cell_degrees``,
+then one ``[row, col, lat, lon, stream_id, mention_id]`` array per
+place mention, where ``(row, col)`` is the grid cell of
+``cell_degrees`` on a side containing the point.  :class:`GeoIndex`
+groups these by cell on loading, so geographic queries over a chunk
+can be answered without deserializing its
+:class:`streamcorpus.StreamItem` objects:
+
+.. code-block:: python
+
+    from streamcorpus_opensextant.geo_index import GeoIndex, sidecar_path
+    index = GeoIndex(sidecar_path('/data/geo', '/data/in/chunk-0001.sc.xz'))
+    for stream_id, mention_id, lat, lon in \\
+            index.query(south=40, west=-5, north=52, east=10):
+        ...
+
+.. autoclass:: GeoIndex
+.. autoclass:: GeoIndexWriter
+.. autofunction:: sidecar_path
+.. autofunction:: place_coordinates
+
+'''
+from __future__ import absolute_import
+import collections
+import hashlib
+import json
+import logging
+import math
+import os
+
+logger = logging.getLogger('streamcorpus_pipeline' + '.' + __name__)
+
+sidecar_suffix = '.geo.jsonl'
+
+
+def sidecar_path(geo_index_dir, i_str):
+    '''Path of the sidecar for input chunk `i_str` in `geo_index_dir`.
+
+    The sidecar is named after the last path component of `i_str`
+    and a short hash of all of it, so that ``/in/a/chunk-0001.sc.xz``
+    gets a name like ``chunk-0001.sc.xz.3f2a9c01d4.geo.jsonl``, and
+    chunks with the same name in different directories do not
+    overwrite each other's sidecars.
+
+    '''
+    if not i_str:
+        raise ValueError('a geo index sidecar needs an input chunk name')
+    if isinstance(i_str, unicode):
+        i_str = i_str.encode('utf8')
+    name = os.path.basename(i_str.rstrip('/')) or 'stream'
+    digest = hashlib.sha1(i_str).hexdigest()[:10]
+    return os.path.join(geo_index_dir,
+                        '%s.%s%s' % (name, digest, sidecar_suffix))
+
+
+def place_coordinates(anno):
+    '''Get ``(latitude, longitude)`` from an OpenSextant annotation.
+
+    Returns :const:`None` if the annotation has no resolved place or
+    the gazetteer marked its coordinate invalid.
+
+    '''
+    place = anno.get('features', {}).get('place') or {}
+    geocoord = place.get('geocoord') or {}
+    if geocoord.get('isValid') is False:
+        return None
+    lat = place.get('latitude', geocoord.get('latitude'))
+    lon = place.get('longitude', geocoord.get('longitude'))
+    if lat is None or lon is None:
+        return None
+    return float(lat), float(lon)
+
+
+def cell_key(lat, lon, cell_degrees):
+    '''Grid cell containing (`lat`, `lon`), as a ``(row, col)`` pair.'''
+    return (int(math.floor(lat / cell_degrees)),
+            int(math.floor(lon / cell_degrees)))
+
+
+class GeoIndexWriter(object):
+    '''Write the sidecar for one chunk as its items are tagged.
+
+    Creating the writer creates (or truncates) the file at `path`
+    and writes its header.
+
+    .. automethod:: add
+    .. automethod:: flush
+    .. automethod:: close
+
+    '''
+    def __init__(self, path, cell_degrees=1.0):
+        self.path = path
+        self.cell_degrees = cell_degrees
+        self.num_points = 0
+        self.pending = []
+        dir_path = os.path.dirname(path)
+        if dir_path and not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+        self.fh = open(path, 'wb')
+        self.fh.write(json.dumps({'cell_degrees': cell_degrees}) + '\n')
+        self.fh.flush()
+
+    def __len__(self):
+        return self.num_points
+
+    def add(self, lat, lon, stream_id, mention_id):
+        '''Record that `mention_id` in `stream_id` is at (`lat`, `lon`).
+
+        Nothing reaches the file until :meth:`flush`.
+
+        '''
+        row, col = cell_key(lat, lon, self.cell_degrees)
+        self.pending.append(json.dumps(
+            [row, col, lat, lon, stream_id, mention_id],
+            separators=(',', ':')) + '\n')
+        self.num_points += 1
+
+    def flush(self):
+        '''Append the points added since the last flush to the file.'''
+        if self.pending:
+            self.fh.write(''.join(self.pending))
+            self.pending = []
+        self.fh.flush()
+
+    def close(self):
+        '''Flush and close the file.'''
+        self.flush()
+        self.fh.close()
+        logger.debug('wrote %d geo points to %s', self.num_points, self.path)
+
+
+class GeoIndex(object):
+    '''Read a sidecar written by :class:`GeoIndexWriter`.
+
+    A partially written last line, as left by a worker killed while
+    writing, is ignored.
+
+    .. automethod:: query
+
+    '''
+    def __init__(self, path):
+        self.cells = collections.defaultdict(list)
+        with open(path, 'rb') as fh:
+            header = json.loads(fh.readline())
+            self.cell_degrees = header['cell_degrees']
+            for line in fh:
+                try:
+                    row, col, lat, lon, stream_id, mention_id = \
+                        json.loads(line)
+                except ValueError:
+                    logger.warn('ignoring truncated line in %s', path)
+                    continue
+                self.cells[(row, col)].append(
+                    (lat, lon, stream_id, mention_id))
+
+    def query(self, south, west, north, east):
+        '''Find mentions inside a bounding box.
+
+        If `west` is greater than `east`, the box is taken to cross
+        the antimeridian.
+
+        :return: iterator of ``(stream_id, mention_id, lat, lon)``
+
+        '''
+        if west > east:
+            spans = [(west, 180.0), (-180.0, east)]
+        else:
+            spans = [(west, east)]
+
+        row_min, _ = cell_key(south, 0, self.cell_degrees)
+        row_max, _ = cell_key(north, 0, self.cell_degrees)
+        for lo, hi in spans:
+            _, col_min = cell_key(0, lo, self.cell_degrees)
+            _, col_max = cell_key(0, hi, self.cell_degrees)
+            num_cells = (row_max - row_min + 1) * (col_max - col_min + 1)
+            if num_cells > len(self.cells):
+                ## cheaper to look at every occupied cell
+                candidates = [points for (row, col), points
+                              in self.cells.iteritems()
+                              if row_min <= row <= row_max
+                              and col_min <= col <= col_max]
+            else:
+                candidates = [self.cells[(row, col)]
+                              for row in xrange(row_min, row_max + 1)
+                              for col in xrange(col_min, col_max + 1)
+                              if (row, col) in self.cells]
+            for points in candidates:
+                for lat, lon, stream_id, mention_id in points:
+                    if south <= lat <= north and lo <= lon <= hi:
+                        yield stream_id, mention_id, lat, lon
@@ -13,50 +13,69 @@ https://github.com/OpenSextant/OpenSextantToolbox/ as a tagger in
       reader: from_local_chunks
       incremental_transforms: [language, guess_media_type, clean_html,
                                title, hyperlink_labels, clean_visible,
-                               opensextant]
-      batch_transforms: [multi_token_match_align_labels]
+                               nltk_tokenizer, opensextant]
       writers: [to_local_chunks]
       opensextant:
-        path_in_third: opensextant/opensextant-current
-      multi_token_match_align_labels:
-        annotator_id: author
-        tagger_id: opensextant
+        network_address: localhost:8182
 
 The ``opensextant`` stage is an incremental transform.  Failures on
 individual stream items will result in those stream items remaining in
 the stream, but without any tagging.  
 
-Note that this stage does *not* run its own aligner, unlike older
-tagger stages.  If desired, you must explicitly include an aligner in
-``batch_transforms`` to convert document-level
-:class:`streamcorpus.Rating` objects to token-level
-:class:`streamcorpus.Token` objects.
+This stage aligns the OpenSextant annotations itself, in a single
+pass over each stream item's tokens.  Along with the token-level
+entity types and mention IDs, it attaches token-level
+:class:`streamcorpus.Label` objects and document-level
+:class:`streamcorpus.Rating` objects under the ``opensextant``
+annotator ID, and fills in
+:attr:`streamcorpus.ContentItem.relations` and
+:attr:`streamcorpus.ContentItem.attributes`.  There is no need to
+add a separate aligner such as ``multi_token_match_align_labels`` to
+``batch_transforms`` for OpenSextant's own mentions.
 
 For all stages that expect a tagger ID, this uses a tagger ID of
-``opensextant``.  The stage has no configuration beyond `rest_url`
+``opensextant``.  Beyond the service location, the only optional
+output is a per-chunk geospatial sidecar index, see
+:mod:`streamcorpus_opensextant.geo_index`.
 
 .. autoclass:: OpenSextantTagger
    :show-inheritance:
 
 '''
 from __future__ import absolute_import
+import collections
 import itertools
 import json
 import logging
 import os.path
 import sys
+import threading
 import time
 import traceback
 
-import requests
-from sortedcollection import SortedCollection
-
+## requests and sortedcollection are imported when they are first
+## needed, so neither loading the stage registry nor constructing the
+## stage pays for them.  streamcorpus is already loaded by
+## streamcorpus_pipeline.
 from streamcorpus import Chunk, Tagging, Sentence, Token, make_stream_time, \
-    OffsetType, EntityType, MentionType
+    OffsetType, EntityType, MentionType, Annotator, Target, Label, Rating, \
+    RelationType, Attribute, AttributeType
+## streamcorpus does not export Relation at the top level
+from streamcorpus.ttypes import Relation
 from streamcorpus_pipeline.stages import IncrementalTransform
 
+from streamcorpus_opensextant.dedup import DedupCache, Entry, diff_tokens, \
+    join_regions, shift_annotations, unjoin_annotations
+from streamcorpus_opensextant.geo_index import GeoIndexWriter, \
+    place_coordinates, sidecar_path
+
 logger = logging.getLogger('streamcorpus_pipeline' + '.' + __name__)
 
+clean_visible_headers = {
+    'content-encoding': 'UTF-8',
+    'content-type': 'text/plain; charset=UTF-8',
+}
+
 
 class OpenSextantTagger(IncrementalTransform):
     ''':mod:`streamcorpus_pipeline` tagger stage for OpenSextant.
@@ -73,12 +92,17 @@ class OpenSextantTagger(IncrementalTransform):
     
     .. automethod:: __init__
     .. automethod:: process_path
+    .. automethod:: route
+    .. automethod:: warm_up
     .. automethod:: shutdown
 
     '''
 
     config_name = 'opensextant'
     tagger_id = 'opensextant'
+    tagger_version = '2.1'
+    ## taggings pieced together from a near-duplicate's annotations
+    near_duplicate_version = '2.1-near-duplicate'
 
     default_config = {
         'scheme': 'http',
@@ -87,7 +111,29 @@ class OpenSextantTagger(IncrementalTransform):
         'verify_ssl': False,
         'username': None,
         'password': None,
-        'cert': None
+        'cert': None,
+        'geo_index_dir': None,
+        'geo_cell_degrees': 1.0,
+        'language_service_paths': {},
+        'only_listed_languages': False,
+        'min_clean_visible_bytes': 0,
+        'max_clean_visible_bytes': None,
+        'min_letter_fraction': None,
+        'quality_sample_bytes': 65536,
+        'warmup_connections': 0,
+        'warmup_text': 'Traveling to Paris, Texas.',
+        'warmup_timeout': 60,
+        'dedup_window': 0,
+        'dedup_threshold': 0.8,
+        'dedup_shingle_size': 5,
+        'dedup_sketch_size': 64,
+        'dedup_max_bytes': 64 * 2**20,
+        'dedup_max_changed_fraction': 0.5,
+        'dedup_max_diff_bytes': 65536,
+        'stream_threshold_bytes': None,
+        'stream_chunk_bytes': 65536,
+        'timeout': 10,
+        'stream_timeout_per_mb': 10,
     }
 
     def __init__(self, config, *args, **kwargs):
@@ -112,52 +158,340 @@ class OpenSextantTagger(IncrementalTransform):
         file (containing the private key and the certificate) or as a
         tuple of both file's path `cert=('cert.crt', 'cert.key')`
 
+        Optionally, `config` can also contain `geo_index_dir`, a
+        directory in which to write a
+        :mod:`~streamcorpus_opensextant.geo_index` sidecar for each
+        input chunk, with grid cells `geo_cell_degrees` on a side.
+        Each item's places are flushed to the sidecar before
+        :meth:`process_item` returns.  The previous chunk's sidecar is
+        closed when the first item of the next chunk arrives, and the
+        last one by :meth:`shutdown`.  Items processed without an
+        ``i_str`` in their context are not indexed.  By default no
+        sidecar is written.
+
+        Before anything is sent, each stream item is routed by the
+        language code set by the ``language`` stage.
+        `language_service_paths` maps language codes to the
+        ``service_path`` to use for them, or to :const:`None` to skip
+        that language.  Languages not listed, including undetected
+        ones, go to ``service_path`` unless `only_listed_languages`
+        is set, in which case they are skipped.  Items are also
+        skipped if their clean_visible is shorter than
+        `min_clean_visible_bytes` or longer than
+        `max_clean_visible_bytes`, or if less than
+        `min_letter_fraction` of the non-space characters in its first
+        `quality_sample_bytes` are letters.  :attr:`route_counts`
+        counts each routing decision.
+
+        The HTTP session, and with it :mod:`requests`, is only
+        created when first needed.  If `warmup_connections` is
+        positive, the constructor instead calls :meth:`warm_up` to
+        create it and open that many pooled connections, sending
+        `warmup_text` as a probe document to every configured service
+        path, so the first real stream item does not pay for
+        connection setup or for OpenSextant's cold start.
+
+        If `dedup_window` is positive, the results for that many
+        recent distinct bodies in the current input chunk are kept
+        in a :class:`~streamcorpus_opensextant.dedup.DedupCache`.
+        Exact copies reuse a cached result outright.  Bodies whose
+        estimated shingle similarity to a cached body is at least
+        `dedup_threshold` reuse its annotations on shared runs of
+        words and send only their changed words to the service,
+        unless the changed words make up more than
+        `dedup_max_changed_fraction` of the text, in which case the
+        whole body is sent.  The same happens, without diffing at
+        all, for bodies over `dedup_max_diff_bytes`, since the word
+        diff can take quadratic time, or whose growth in length
+        alone shows that too much changed.  Results built this way
+        record the
+        ``stream_id`` they were derived from as ``nearDuplicateOf``
+        and carry the tagger version :attr:`near_duplicate_version`.
+        `dedup_shingle_size` words make a shingle, and each body is
+        sketched by its `dedup_sketch_size` smallest shingle hashes.
+        The cache holds at most `dedup_max_bytes` of bodies and raw
+        taggings, and bodies big enough to stream bypass it.
+        :attr:`dedup_counts` counts ``exact``, ``near``,
+        ``near_fallback``, ``unique`` and ``too_large`` bodies.
+
+        If `stream_threshold_bytes` is set, bodies larger than that
+        are uploaded with chunked transfer encoding in pieces of
+        `stream_chunk_bytes`, sliced from a :class:`memoryview` of
+        clean_visible so that the body is never copied.  Otherwise
+        the whole body is handed to the HTTP library, which copies it
+        while building the request.  Their responses are read in
+        `stream_chunk_bytes` pieces and joined once into the string
+        stored as raw_tagging; the response object keeps no copy of
+        its own.  For every response, the copy of the document that
+        OpenSextant echoes back in ``content`` is dropped as soon as
+        the JSON is parsed, so it is not held during alignment.
+
+        Requests time out after `timeout` seconds without a response
+        byte.  OpenSextant sends nothing until it has tagged the whole
+        document, so a streamed body gets `stream_timeout_per_mb`
+        more seconds for each megabyte.
+
         :param dict config: local configuration dictionary
 
         '''
         super(OpenSextantTagger, self).__init__(config, *args, **kwargs)
         kwargs = {}
-        self.rest_url = config['scheme'] + '://' + config['network_address'] \
-                        + config['service_path']
+        self.base_url = config['scheme'] + '://' + config['network_address']
+        self.rest_url = self.base_url + config['service_path']
         self.verify_ssl = config['verify_ssl']
 
-        ## Session carries connection pools that automatically provide
-        ## HTTP keep-alive, so we can send many documents over one
-        ## connection.
-        self.session = requests.Session()
-        username = config.get('username')
-        password = config.get('password')
+        self.language_service_paths = dict(
+            (code.lower(), path) for code, path
+            in (config.get('language_service_paths') or {}).iteritems())
+        self.only_listed_languages = config.get('only_listed_languages', False)
+        self.min_clean_visible_bytes = config.get('min_clean_visible_bytes') or 0
+        self.max_clean_visible_bytes = config.get('max_clean_visible_bytes')
+        self.min_letter_fraction = config.get('min_letter_fraction')
+        self.quality_sample_bytes = config.get('quality_sample_bytes', 65536)
+        ## counts of routing decisions, e.g. ``sent:en`` or
+        ## ``skipped:too_large``
+        self.route_counts = collections.Counter()
+
+        ## created by the session property on first use
+        self._session = None
+
+        self.geo_index_dir = config.get('geo_index_dir')
+        self.geo_cell_degrees = config.get('geo_cell_degrees', 1.0)
+        self.geo_index = None
+        self.geo_i_str = None
+        ## set once we have warned about an item with no input chunk
+        self.geo_warned = False
+
+        dedup_window = config.get('dedup_window') or 0
+        if dedup_window > 0:
+            self.dedup_cache = DedupCache(
+                dedup_window,
+                threshold=config.get('dedup_threshold', 0.8),
+                shingle_size=config.get('dedup_shingle_size', 5),
+                sketch_size=config.get('dedup_sketch_size', 64),
+                max_bytes=config.get('dedup_max_bytes', 64 * 2**20))
+        else:
+            self.dedup_cache = None
+        self.dedup_max_changed_fraction = \
+            config.get('dedup_max_changed_fraction', 0.5)
+        self.dedup_max_diff_bytes = config.get('dedup_max_diff_bytes', 65536)
+        self.dedup_i_str = None
+        self.dedup_counts = collections.Counter()
+
+        self.stream_threshold_bytes = config.get('stream_threshold_bytes')
+        self.stream_chunk_bytes = config.get('stream_chunk_bytes') or 65536
+        self.timeout = config.get('timeout', 10)
+        self.stream_timeout_per_mb = config.get('stream_timeout_per_mb', 10)
+
+        self.warmup_text = config.get('warmup_text') or \
+                           self.default_config['warmup_text']
+        self.warmup_timeout = config.get('warmup_timeout', 60)
+        ## set once a probe document has been tagged on every
+        ## connection requested by warmup_connections
+        self.warmed_up = False
+        self.warmup_seconds = None
+        self.warmup_connections = config.get('warmup_connections') or 0
+        if self.warmup_connections > 0:
+            self.warm_up(self.warmup_connections)
+
+    @property
+    def session(self):
+        '''The :class:`requests.Session` used for all requests.
+
+        This is created, and :mod:`requests` imported, on first use.
+        The session carries connection pools that automatically
+        provide HTTP keep-alive, so we can send many documents over
+        one connection.
+
+        '''
+        if self._session is None:
+            self._session = self.make_session()
+        return self._session
+
+    @session.setter
+    def session(self, session):
+        self._session = session
+
+    def make_session(self):
+        import requests
+        from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
+        from requests.auth import HTTPBasicAuth
+        session = requests.Session()
+        username = self.config.get('username')
+        password = self.config.get('password')
         if username and password:
-            self.session.auth = HTTPBasicAuth(username, password)
+            session.auth = HTTPBasicAuth(username, password)
 
-        cert = config.get('cert')
+        cert = self.config.get('cert')
         if cert and isinstance(cert, (list, tuple)):
-            self.session.cert = tuple(cert)
+            session.cert = tuple(cert)
         elif cert:
-            self.session.cert = cert
+            session.cert = cert
+
+        if self.warmup_connections > 0:
+            ## keep every warmed connection in the pool
+            session.mount(self.base_url, HTTPAdapter(
+                pool_maxsize=max(self.warmup_connections, DEFAULT_POOLSIZE)))
+        return session
 
     def shutdown(self):
         '''Try to stop processing.
 
-        Does nothing, since all of the work is done in-process.
+        All of the work is done in-process, so this only closes the
+        current geo index sidecar, if any, and logs the counts of
+        routing and deduplication decisions.
         
         '''
-        pass
+        self.close_geo_index()
+        if self.route_counts:
+            logger.info('opensextant routing: %s', ', '.join(
+                '%s=%d' % item for item in sorted(self.route_counts.items())))
+        if self.dedup_counts:
+            logger.info('opensextant dedup: %s', ', '.join(
+                '%s=%d' % item for item in sorted(self.dedup_counts.items())))
+
+    def warm_up(self, num_connections):
+        '''Open `num_connections` pooled connections to the service.
+
+        Probe documents are POSTed concurrently, at least one to each
+        distinct service path in use (``service_path`` and the values
+        of `language_service_paths`), so that the connections are
+        all established and every extractor has tagged something
+        before the first stream item arrives.
+
+        The probes share no session state: each is prepared up front
+        and then sent directly through the session's mounted
+        :class:`requests.adapters.HTTPAdapter`, whose connection pool
+        is thread-safe, so each thread checks out its own connection.
+
+        Failures are logged rather than raised; :attr:`warmed_up`
+        records whether every probe succeeded, and
+        :attr:`warmup_seconds` how long they took.
+
+        :return: :attr:`warmed_up`
 
-    def request_json(self, si):
+        '''
+        import requests
+        urls = [self.rest_url] + sorted(set(
+            self.base_url + path
+            for path in self.language_service_paths.itervalues()
+            if path and self.base_url + path != self.rest_url))
+        session = self.session
+        probes = []
+        for idx in xrange(max(num_connections, len(urls))):
+            url = urls[idx % len(urls)]
+            probes.append(session.prepare_request(requests.Request(
+                'POST', url, data=self.warmup_text,
+                headers=clean_visible_headers)))
+
+        errors = []
+        def probe(request):
+            try:
+                response = session.get_adapter(request.url).send(
+                    request,
+                    verify=self.verify_ssl,
+                    cert=session.cert,
+                    timeout=self.warmup_timeout,
+                )
+                response.raise_for_status()
+                json.loads(response.content)
+            except Exception, exc:
+                errors.append((request.url, exc))
+
+        start = time.time()
+        threads = [threading.Thread(target=probe, args=(request,))
+                   for request in probes]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        if errors:
+            logger.warn('warm-up of %d connections failed after %.3f sec: '
+                        '%s: %r', len(probes), elapsed,
+                        errors[0][0], errors[0][1])
+            return False
+        self.warmed_up = True
+        self.warmup_seconds = elapsed
+        logger.info('warmed up %d connections to %s in %.3f sec',
+                    len(probes), ', '.join(urls), elapsed)
+        return True
+
+    def close_geo_index(self):
+        '''Close the geo index sidecar for the current input chunk.
+
+        Every tagged item's places are already on disk by the time
+        :meth:`process_item` returns, so this only releases the file.
+
+        '''
+        if self.geo_index is not None:
+            self.geo_index.close()
+        self.geo_index = None
+
+    def route(self, si):
+        '''Choose the URL to send `si` to.
+
+        :return: URL string, or :const:`None` to skip `si`
+
+        '''
+        cv = si.body.clean_visible
+        lang = (si.body.language and si.body.language.code or '').lower()
+        if len(cv) < self.min_clean_visible_bytes:
+            decision = 'too_small'
+        elif self.max_clean_visible_bytes is not None and \
+             len(cv) > self.max_clean_visible_bytes:
+            decision = 'too_large'
+        elif lang in self.language_service_paths and \
+             not self.language_service_paths[lang]:
+            decision = 'language'
+        elif lang not in self.language_service_paths and \
+             self.only_listed_languages:
+            decision = 'language'
+        elif self.min_letter_fraction is not None and \
+             letter_fraction(cv[:self.quality_sample_bytes]) \
+             < self.min_letter_fraction:
+            decision = 'low_quality'
+        else:
+            decision = None
+
+        if decision is not None:
+            self.route_counts['skipped:' + decision] += 1
+            logger.debug('skipping %s (%d bytes, language=%r): %s',
+                         si.stream_id, len(cv), lang, decision)
+            return None
+
+        self.route_counts['sent:' + (lang or 'unknown')] += 1
+        if lang in self.language_service_paths:
+            return self.base_url + self.language_service_paths[lang]
+        return self.rest_url
+
+    def request_json(self, si, rest_url=None, data=None):
+        if rest_url is None:
+            rest_url = self.rest_url
+        if data is None:
+            data = si.body.clean_visible
         # clean_visible will be UTF-8 encoded
         logger.debug('POST %d bytes of clean_visible to %s',
-                     len(si.body.clean_visible), self.rest_url)
-        headers = {
-            'content-encoding': 'UTF-8',
-            'content-type': 'text/plain; charset=UTF-8',
-        }
+                     len(data), rest_url)
+        if self.should_stream(data):
+            ## a generator body makes requests use chunked transfer
+            ## encoding; see read_response for the other half
+            body = iter_chunks(data, self.stream_chunk_bytes)
+            stream = True
+            timeout = self.timeout + \
+                self.stream_timeout_per_mb * len(data) / float(2**20)
+        else:
+            body = data
+            stream = False
+            timeout = self.timeout
         response = self.session.post(
-            self.rest_url,
-            data=si.body.clean_visible,
+            rest_url,
+            data=body,
             verify=self.verify_ssl,
-            headers=headers,
-            timeout=10,
+            headers=clean_visible_headers,
+            timeout=timeout,
+            stream=stream,
         )
         ## save JSON for testing; make file names based on length of clean_visible
         #fname = 'query-%d.json' % len(si.body.clean_visible)
@@ -165,15 +499,53 @@ class OpenSextantTagger(IncrementalTransform):
         #open(fpath, 'wb').write(response.content)
         return response
 
+    def should_stream(self, data):
+        '''Decide whether `data` is big enough to stream.'''
+        return self.stream_threshold_bytes is not None and \
+            len(data) > self.stream_threshold_bytes
+
+    def read_response(self, response, streamed):
+        '''Read the body of `response` from :meth:`request_json`.
+
+        For a `streamed` response, this reads pieces straight off the
+        connection and joins them once, without ever populating
+        ``response.content``, so the returned string is the only
+        full copy of the body.
+
+        '''
+        if streamed:
+            return ''.join(response.iter_content(self.stream_chunk_bytes))
+        return response.content
+
+    def fetch(self, si, rest_url, data=None):
+        '''Send `data`, by default `si`'s clean_visible, to `rest_url`.
+
+        :return: pair of the parsed result, without the echoed
+          ``content``, and the raw bytes for the Tagging
+
+        '''
+        if data is None:
+            data = si.body.clean_visible
+        streamed = self.should_stream(data)
+        raw_tagging = self.read_response(
+            self.request_json(si, rest_url, data=data), streamed)
+        return parse_result(raw_tagging), raw_tagging
+
 
     def process_item(self, si, context=None):
         '''Run OpenSextant over a single stream item.
 
-        This ignores the `context`, and always returns the input
-        stream item `si`.  Its sole action is to add a ``opensextant``
-        value to the tagger-keyed fields in `si.body`, provided that
-        `si` in fact has a
-        :attr:`~streamcorpus.ContentItem.clean_visible` part.
+        This always returns the input stream item `si`.  Its sole
+        action is to add a ``opensextant`` value to the tagger-keyed
+        fields in `si.body`, provided that `si` in fact has a
+        :attr:`~streamcorpus.ContentItem.clean_visible` part.  If a
+        geo index is configured, ``i_str`` from `context` names the
+        input chunk whose sidecar collects the item's places.  Items
+        that :meth:`route` rejects are returned untouched.  With
+        deduplication configured, ``i_str`` also marks the chunk
+        boundaries at which the cache is cleared, and a result built
+        from a near duplicate is stored with
+        :attr:`near_duplicate_version` instead of :attr:`tagger_version`.
 
         :param si: stream item to process
         :paramtype si: :class:`streamcorpus.StreamItem`
@@ -181,41 +553,214 @@ class OpenSextantTagger(IncrementalTransform):
         :return: `si`
 
         '''
-        if si.body and si.body.clean_visible:
-            response = self.request_json(si)
+        index_geo = self.geo_index_dir and \
+            self.start_geo_index((context or {}).get('i_str'))
 
-            result = json.loads(response.content)
+        if si.body and si.body.clean_visible:
+            rest_url = self.route(si)
+            if rest_url is None:
+                return si
+            if self.dedup_cache is None:
+                result, raw_tagging = self.fetch(si, rest_url)
+            else:
+                result, raw_tagging = self.request_dedup(
+                    si, rest_url, (context or {}).get('i_str'))
 
             ## remove a Tagging entry from nltk_tokenizer
             #si.body.taggings.pop('nltk_tokenizer')
+            if 'nearDuplicateOf' in result:
+                tagger_version = self.near_duplicate_version
+            else:
+                tagger_version = self.tagger_version
             tagging = Tagging(
                 tagger_id=self.tagger_id,
-                tagger_version='2.1',
+                tagger_version=tagger_version,
                 generation_time=make_stream_time(time.time()),
-                raw_tagging = response.content
+                raw_tagging = raw_tagging
             )
             si.body.taggings[self.tagger_id] = tagging
 
-            self.annotate_sentences(si, result)
+            mentions = self.annotate_sentences(si, result)
 
-            #si.body.relations[self.tagger_id] = make_relations(result)
-            #si.body.attributes[self.tagger_id] = make_attributes(result)
+            if index_geo:
+                self.index_places(si, mentions)
 
         return si
 
+    def request_dedup(self, si, rest_url, i_str):
+        '''Get the OpenSextant result for `si`, reusing the result for
+        an earlier copy of its text from input chunk `i_str` if there
+        is one.
+
+        Bodies big enough to stream are sent straight to the service
+        and not cached.  The cached result never holds the echoed
+        ``content``, which :func:`parse_result` drops.
+
+        :return: pair of decoded result and raw tagging bytes
+
+        '''
+        if i_str != self.dedup_i_str:
+            self.dedup_cache.reset()
+            self.dedup_i_str = i_str
+
+        data = si.body.clean_visible
+        if self.should_stream(data):
+            self.dedup_counts['too_large'] += 1
+            return self.fetch(si, rest_url)
+
+        digest = self.dedup_cache.digest(data)
+        entry = self.dedup_cache.exact(rest_url, digest)
+        if entry is not None:
+            self.dedup_counts['exact'] += 1
+            logger.debug('reusing exact duplicate result for %s',
+                         si.stream_id)
+            ## move it to the front of the window
+            self.dedup_cache.add(rest_url, digest, entry)
+            return entry.result, entry.raw_tagging
+
+        data_sketch = self.dedup_cache.sketch(data)
+        entry = self.dedup_cache.near(rest_url, data_sketch)
+        result = None
+        if entry is not None:
+            result = self.retag_changes(si, rest_url, entry)
+            if result is None:
+                self.dedup_counts['near_fallback'] += 1
+        else:
+            self.dedup_counts['unique'] += 1
+        if result is None:
+            result, raw_tagging = self.fetch(si, rest_url)
+        else:
+            self.dedup_counts['near'] += 1
+            raw_tagging = json.dumps(result)
+
+        self.dedup_cache.add(rest_url, digest, Entry(
+            data, data_sketch, result, raw_tagging, si.stream_id))
+        return result, raw_tagging
+
+    def retag_changes(self, si, rest_url, entry):
+        '''Build a result for `si` from the near-duplicate `entry`.
+
+        Annotations on runs of words shared with `entry` are moved
+        to their new offsets, and only the changed words are sent to
+        the service.
+
+        :return: the new result, marked with ``nearDuplicateOf``, or
+          :const:`None` if more than `dedup_max_changed_fraction` of
+          the text changed, or the text is too big to diff, and it
+          should be tagged from scratch
+
+        '''
+        data = si.body.clean_visible
+        if self.dedup_max_diff_bytes is not None and \
+           len(data) > self.dedup_max_diff_bytes:
+            logger.debug('%s is too big to diff against %s',
+                         si.stream_id, entry.stream_id)
+            return None
+        ## any growth in length is mostly new words
+        grown = len(data) - len(entry.data)
+        if grown > self.dedup_max_changed_fraction * len(data):
+            logger.debug('%s differs in length too much from %s',
+                         si.stream_id, entry.stream_id)
+            return None
+
+        old_text = entry.data.decode('utf8')
+        text = data.decode('utf8')
+        shared, changed = diff_tokens(old_text, text)
+        num_changed = sum(end - start for start, end in changed)
+        if num_changed > self.dedup_max_changed_fraction * len(text):
+            logger.debug('%d of %d characters changed in %s, '
+                         'not reusing %s', num_changed, len(text),
+                         si.stream_id, entry.stream_id)
+            return None
+
+        annos = shift_annotations(entry.result.get('annoList', []), shared)
+        if changed:
+            joined, segments = join_regions(text, changed)
+            logger.debug('re-tagging %d changed characters of %d in %s',
+                         len(joined), len(text), si.stream_id)
+            fresh, _ = self.fetch(si, rest_url, data=joined.encode('utf8'))
+            annos.extend(unjoin_annotations(fresh.get('annoList', []),
+                                            segments))
+
+        return dict(entry.result, annoList=annos,
+                    nearDuplicateOf=entry.stream_id)
+
+    def start_geo_index(self, i_str):
+        '''Make sure the sidecar for input chunk `i_str` exists.
+
+        On the first item of a new chunk, this closes the previous
+        chunk's sidecar and creates an empty one for `i_str`, so that
+        a chunk without any places still gets a sidecar.
+
+        :return: :const:`False` if there is no `i_str` and so no
+          sidecar to add the item's places to
+
+        '''
+        if not i_str:
+            if not self.geo_warned:
+                logger.warn('no i_str in context, so not indexing places')
+                self.geo_warned = True
+            return False
+        if self.geo_index is None or i_str != self.geo_i_str:
+            self.close_geo_index()
+            self.geo_index = GeoIndexWriter(
+                sidecar_path(self.geo_index_dir, i_str),
+                self.geo_cell_degrees)
+            self.geo_i_str = i_str
+        return True
+
+    def index_places(self, si, mentions):
+        '''Append the resolved places among `mentions` to the current
+        sidecar, and flush it to disk.
+
+        '''
+        for mention in mentions:
+            if not mention.hierarchy.startswith('Geo.'):
+                continue
+            coords = place_coordinates(mention.anno)
+            if coords is not None:
+                self.geo_index.add(coords[0], coords[1],
+                                   si.stream_id, mention.mention_id)
+        self.geo_index.flush()
+
 
     def annotate_sentences(self, si, result):
-        logger.info(json.dumps(result, indent=4, sort_keys=4))
-        #sys.exit()
+        '''Align `result` onto the tokens of `si` in a single pass.
+
+        Besides setting the entity and mention fields on each
+        :class:`streamcorpus.Token`, this attaches a
+        :class:`streamcorpus.Label` for each mention's target to its
+        tokens, records a document-level :class:`streamcorpus.Rating`
+        per target in :attr:`streamcorpus.StreamItem.ratings`, and
+        derives :class:`streamcorpus.Relation` and
+        :class:`streamcorpus.Attribute` objects from the mentions
+        found.  The mentions are collected as the annotations are
+        aligned, so no later stage needs to scan the tokens again.
+
+        :return: list of :class:`Mention` aligned to at least one token
+
+        '''
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(json.dumps(result, indent=4, sort_keys=4))
 
         sentences = si.body.sentences.pop('nltk_tokenizer')
         si.body.sentences[self.tagger_id] = sentences
 
-        toks = SortedCollection(
-            itertools.chain(*[sent.tokens for sent in sentences]),
-            key=lambda tok: tok.offsets[OffsetType.CHARS].first
+        ## carry the sentence index along with each token, so that
+        ## mentions can be located for relations and attributes
+        toks = sorted_collection()(
+            ((sent_idx, tok)
+             for sent_idx, sent in enumerate(sentences)
+             for tok in sent.tokens),
+            key=lambda pair: pair[1].offsets[OffsetType.CHARS].first
             )
 
+        annotator = Annotator(annotator_id=self.tagger_id)
+        ## maps target_id to its Rating, in order of first mention
+        ratings = {}
+        target_ids = []
+        mentions = []
+
         cv = si.body.clean_visible.decode('utf8')
         mention_id = 0
         for anno in result.get('annoList', []):
@@ -231,32 +776,224 @@ class OpenSextantTagger(IncrementalTransform):
                 pre = 30
                 post = 30
                 logger.debug('alignment failure:\n\t%s\n\t%s%s%s',
-                                si.body.clean_visible.decode('utf8')[start-pre:end+post],
+                                cv[start-pre:end+post],
                                 ' ' * pre,
                                 anno['matchText'],
                                 ' ' * post,
                 )
 
-            for tok in toks.find_range(start, end):
-                fhierarchy = anno['features']['hierarchy']
-                fh_parts = fhierarchy.split('.')
-                if entity_types.get(fhierarchy):
-                    e_type, m_type = entity_types[fhierarchy]
-                elif entity_types.get(fh_parts[0]):
-                    e_type, m_type = entity_types[fh_parts[0]]
-                else:
-                    e_type, m_type = None, None
-
-                if e_type is not None:
-                    tok.entity_type = e_type
-                    tok.mention_type = m_type
-                    tok.mention_id = mention_id
-                    ## too bad no coref chains, so nominals are not connected
-                    ## to names:
-                    tok.equiv_id = mention_id  
+            fhierarchy = anno['features']['hierarchy']
+            e_type, m_type = lookup_entity_type(fhierarchy)
+            if e_type is None:
+                mention_id += 1
+                continue
+
+            target_id = make_target_id(anno)
+            label = None
+            sentence_id = None
+            for sent_idx, tok in toks.find_range(start, end):
+                if label is None:
+                    label = Label(annotator=annotator,
+                                  target=Target(target_id=target_id))
+                    sentence_id = sent_idx
+                tok.entity_type = e_type
+                tok.mention_type = m_type
+                tok.mention_id = mention_id
+                ## too bad no coref chains, so nominals are not connected
+                ## to names:
+                tok.equiv_id = mention_id  
+                tok.labels.setdefault(self.tagger_id, []).append(label)
+
+            if label is not None:
+                mention_text = anno['matchText'].encode('utf8')
+                rating = ratings.get(target_id)
+                if rating is None:
+                    rating = Rating(annotator=annotator,
+                                    target=Target(target_id=target_id),
+                                    contains_mention=True,
+                                    mentions=[])
+                    ratings[target_id] = rating
+                    target_ids.append(target_id)
+                if mention_text not in rating.mentions:
+                    rating.mentions.append(mention_text)
+                mentions.append(Mention(mention_id, sentence_id, start, end,
+                                        fhierarchy, anno))
 
             mention_id += 1
 
+        if target_ids:
+            si.ratings[self.tagger_id] = [ratings[target_id]
+                                          for target_id in target_ids]
+        si.body.relations[self.tagger_id] = make_relations(mentions, cv)
+        si.body.attributes[self.tagger_id] = make_attributes(mentions, cv)
+        return mentions
+
+
+def parse_result(raw_tagging):
+    '''Parse OpenSextant JSON, dropping the echoed ``content``.'''
+    result = json.loads(raw_tagging)
+    result.pop('content', None)
+    return result
+
+
+_sorted_collection = None
+
+def sorted_collection():
+    '''Get :class:`sortedcollection.SortedCollection`, importing it
+    on first use.
+
+    '''
+    global _sorted_collection
+    if _sorted_collection is None:
+        from sortedcollection import SortedCollection
+        _sorted_collection = SortedCollection
+    return _sorted_collection
+
+
+def iter_chunks(data, chunk_size):
+    '''Yield successive `chunk_size` pieces of `data` as
+    :class:`memoryview` slices, which share its buffer.
+
+    '''
+    view = memoryview(data)
+    for start in xrange(0, len(view), chunk_size):
+        yield view[start:start + chunk_size]
+
+
+def letter_fraction(data):
+    '''Fraction of the non-space characters in UTF-8 `data` that are
+    letters.  Undecodable bytes count as non-letters.
+
+    '''
+    text = data.decode('utf8', 'replace')
+    num_letters = 0
+    num_chars = 0
+    for char in text:
+        if char.isspace():
+            continue
+        num_chars += 1
+        if char.isalpha():
+            num_letters += 1
+    if not num_chars:
+        return 0.0
+    return float(num_letters) / num_chars
+
+
+## A mention collected while aligning: `anno` is the raw OpenSextant
+## annotation, and `start` and `end` are character offsets into
+## clean_visible.
+Mention = collections.namedtuple(
+    'Mention',
+    ['mention_id', 'sentence_id', 'start', 'end', 'hierarchy', 'anno'])
+
+
+def lookup_entity_type(hierarchy):
+    '''Map an OpenSextant feature `hierarchy` to a
+    (:class:`streamcorpus.EntityType`, :class:`streamcorpus.MentionType`)
+    pair, falling back to the top-level category, or (None, None).
+
+    '''
+    if entity_types.get(hierarchy):
+        return entity_types[hierarchy]
+    top = hierarchy.split('.')[0]
+    if entity_types.get(top):
+        return entity_types[top]
+    return None, None
+
+
+def make_target_id(anno):
+    '''Construct a target_id for an OpenSextant annotation.
+
+    Resolved places use the gazetteer ``placeID``; anything else is
+    identified by its hierarchy and its whitespace-normalized,
+    lowercased match text.
+
+    '''
+    place = anno['features'].get('place') or {}
+    if place.get('placeID'):
+        target_id = u'opensextant:place:%s' % place['placeID']
+    else:
+        target_id = u'opensextant:%s:%s' % (
+            anno['features']['hierarchy'],
+            u' '.join(anno['matchText'].lower().split()))
+    return target_id.encode('utf8')
+
+
+## separators allowed between a place and the region containing it,
+## as in "Paris, Texas"
+containing_place_separators = set([u',', u', '])
+
+
+def make_relations(mentions, cv):
+    '''Derive :class:`streamcorpus.Relation` objects from `mentions`.
+
+    OpenSextant does not itself emit relations, so this recognizes
+    the one construction that is reliable from its output: a place
+    immediately followed by a comma and an administrative region,
+    which yields a ``PARTWHOLE_Geographical`` relation from the place
+    to the region.
+
+    :param list mentions: :class:`Mention` tuples from alignment
+    :param unicode cv: decoded clean_visible
+    :return: list of :class:`streamcorpus.Relation`
+
+    '''
+    relations = []
+    places = sorted((m for m in mentions
+                     if m.hierarchy.startswith('Geo.place.')),
+                    key=lambda m: m.start)
+    for m1, m2 in itertools.izip(places, places[1:]):
+        if cv[m1.end:m2.start] not in containing_place_separators:
+            continue
+        place = m2.anno['features'].get('place') or {}
+        if place and place.get('featureClass') != \
+           'Geo.featureType.AdminRegion':
+            continue
+        relations.append(Relation(
+            relation_type=RelationType.PARTWHOLE_Geographical,
+            sentence_id_1=m1.sentence_id,
+            mention_id_1=m1.mention_id,
+            sentence_id_2=m2.sentence_id,
+            mention_id_2=m2.mention_id,
+        ))
+    return relations
+
+
+def make_attributes(mentions, cv):
+    '''Derive :class:`streamcorpus.Attribute` objects from `mentions`.
+
+    Each ``Person.name.title.*`` mention becomes a ``PER_TITLE``
+    attribute.  When the title is directly followed by a person's
+    name, as in "President Smith", the attribute is attached to the
+    name's mention; otherwise it is attached to the title itself.
+
+    :param list mentions: :class:`Mention` tuples from alignment
+    :param unicode cv: decoded clean_visible
+    :return: list of :class:`streamcorpus.Attribute`
+
+    '''
+    attributes = []
+    ordered = sorted(mentions, key=lambda m: m.start)
+    for idx, m in enumerate(ordered):
+        if not m.hierarchy.startswith('Person.name.title.'):
+            continue
+        owner = m
+        if idx + 1 < len(ordered):
+            nxt = ordered[idx + 1]
+            if nxt.hierarchy.startswith('Person') and \
+               not nxt.hierarchy.startswith('Person.name.title.') and \
+               not cv[m.end:nxt.start].strip():
+                owner = nxt
+        title = m.anno['matchText'].encode('utf8')
+        attributes.append(Attribute(
+            attribute_type=AttributeType.PER_TITLE,
+            evidence=title,
+            value=title,
+            sentence_id=owner.sentence_id,
+            mention_id=owner.mention_id,
+        ))
+    return attributes
+
 
 entity_types = {
     ## most events are unnamed, so default to NOM
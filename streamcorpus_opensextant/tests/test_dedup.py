@@ -0,0 +1,135 @@
+from __future__ import absolute_import
+
+from streamcorpus_opensextant.dedup import DedupCache, Entry, sketch, \
+    similarity, band_keys, diff_tokens, shift_annotations, join_regions, \
+    unjoin_annotations
+
+story = ('The president traveled to Paris, Texas on Monday to meet '
+         'with local officials about the drought and its effect on '
+         'farmers across the region.')
+
+
+def test_similarity():
+    assert similarity(sketch(story), sketch(story)) == 1.0
+    retweet = 'RT @someone: ' + story
+    assert similarity(sketch(story), sketch(retweet)) > 0.8
+    other = ' '.join(reversed(story.split()))
+    assert similarity(sketch(story), sketch(other)) == 0.0
+    ## too short to shingle
+    assert sketch('Paris, Texas') == frozenset()
+    assert similarity(sketch('Paris, Texas'), sketch('Paris, Texas')) == 0.0
+
+
+def test_dedup_cache():
+    cache = DedupCache(2, threshold=0.8)
+    url = 'http://localhost:8182/x'
+    for idx, text in enumerate([story, story.upper(), story.lower()]):
+        cache.add(url, cache.digest(text),
+                  Entry(text, cache.sketch(text), {'n': idx}, str(idx),
+                        'si-%d' % idx))
+    assert len(cache) == 2
+    ## the oldest entry was evicted
+    assert cache.exact(url, cache.digest(story)) is None
+    assert cache.exact(url, cache.digest(story.lower())).result == {'n': 2}
+    assert cache.exact('http://other/', cache.digest(story.lower())) is None
+
+    near = cache.near(url, cache.sketch(story.lower() + ' more words here'))
+    assert near.result == {'n': 2}
+    assert cache.near(url, cache.sketch(story)) is None
+
+    cache.reset()
+    assert len(cache) == 0
+    assert cache.num_bytes == 0
+    assert not cache.buckets
+
+
+def test_band_index():
+    retweet = 'RT @someone: ' + story
+    other = ' '.join(reversed(story.split()))
+    assert set(band_keys(sketch(story))) & set(band_keys(sketch(retweet)))
+    assert not set(band_keys(sketch(story))) & set(band_keys(sketch(other)))
+    assert band_keys(frozenset()) == []
+
+    cache = DedupCache(1)
+    url = 'http://localhost:8182/x'
+    for text in [other, story]:
+        cache.add(url, cache.digest(text),
+                  Entry(text, cache.sketch(text), {}, '', 'si'))
+    ## only entries sharing a band are compared
+    assert [entry.data for entry
+            in cache.candidates(url, cache.sketch(retweet))] == [story]
+    assert cache.candidates(url, cache.sketch(other)) == []
+    ## evicting the entry took it out of the index too
+    assert sum(len(keys) for keys in cache.buckets.values()) == \
+        len(band_keys(sketch(story)))
+
+
+def test_dedup_cache_max_bytes():
+    url = 'http://localhost:8182/x'
+    def entry(text):
+        return Entry(text, frozenset(), {}, 'x' * 10, 'si')
+    cache = DedupCache(10, max_bytes=100)
+    for text in ['a' * 40, 'b' * 40, 'c' * 40]:
+        cache.add(url, cache.digest(text), entry(text))
+    ## each entry is 50 bytes, so only the newest two fit
+    assert len(cache) == 2
+    assert cache.num_bytes == 100
+    assert cache.exact(url, cache.digest('a' * 40)) is None
+
+    ## too big to keep at all, and it evicts nothing
+    cache.add(url, cache.digest('d' * 200), entry('d' * 200))
+    assert len(cache) == 2
+    assert cache.exact(url, cache.digest('d' * 200)) is None
+
+
+def test_diff_and_remap():
+    old = u'Breaking news\nParis, Texas is dry.\nFooter A\n'
+    new = u'Paris, Texas is dry.\nSee Liberia.\nFooter A\n'
+    shared, changed = diff_tokens(old, new)
+    assert [new[start:end] for start, end in changed] == [u'See Liberia.']
+    assert [old[start:end] for start, end, _ in shared] == \
+        [u'Paris, Texas is dry.', u'Footer A']
+
+    old_annos = [{'start': 0, 'end': 8, 'matchText': u'Breaking'},
+                 {'start': 14, 'end': 19, 'matchText': u'Paris'},
+                 {'start': 14, 'end': 26, 'matchText': u'Paris, Texas'}]
+    moved = shift_annotations(old_annos, shared)
+    assert [new[a['start']:a['end']] for a in moved] == \
+        [u'Paris', u'Paris, Texas']
+    ## the originals are left alone
+    assert old_annos[1]['start'] == 14
+
+    joined, segments = join_regions(new, changed + [(0, 5)])
+    assert joined == u'See Liberia.\n\nParis'
+    fresh = [{'start': 4, 'end': 11, 'matchText': u'Liberia'},
+             {'start': 10, 'end': 16, 'matchText': u'straddles'},
+             {'start': 14, 'end': 19, 'matchText': u'Paris'}]
+    moved = unjoin_annotations(fresh, segments)
+    assert [new[a['start']:a['end']] for a in moved] == [u'Liberia', u'Paris']
+
+
+def test_diff_retweet():
+    ## a one-line post with a prefix only sends the prefix
+    old = unicode(story)
+    new = u'RT @someone: ' + old
+    shared, changed = diff_tokens(old, new)
+    assert [new[start:end] for start, end in changed] == [u'RT @someone:']
+    assert shared == [(0, len(old), 13)]
+
+    ## respacing inside a shared run splits it where the offsets move
+    new = old.replace(u'Paris, Texas', u'Paris,  Texas')
+    shared, changed = diff_tokens(old, new)
+    assert changed == []
+    assert [old[start:end] for start, end, _ in shared] == \
+        [old[:old.index(u'Texas') - 1], old[old.index(u'Texas'):]]
+
+
+def test_diff_large_edit_in_one_place():
+    ## shared leading and trailing words never reach SequenceMatcher,
+    ## so this is quick despite the size
+    words = [u'w%d' % (idx % 997) for idx in xrange(50000)]
+    old = u' '.join(words)
+    new = u' '.join(words[:20000] + [u'Liberia'] + words[20000:])
+    shared, changed = diff_tokens(old, new)
+    assert [new[start:end] for start, end in changed] == [u'Liberia']
+    assert [delta for _, _, delta in shared] == [0, len(u'Liberia ')]
@@ -0,0 +1,73 @@
+from __future__ import absolute_import
+import os
+import pytest
+
+from streamcorpus_opensextant.geo_index import GeoIndex, GeoIndexWriter, \
+    place_coordinates, sidecar_path
+
+
+def test_sidecar_path():
+    path = sidecar_path('/geo', '/data/chunk-1.sc.xz')
+    assert os.path.dirname(path) == '/geo'
+    assert os.path.basename(path).startswith('chunk-1.sc.xz.')
+    assert path.endswith('.geo.jsonl')
+    assert sidecar_path('/geo', '/data/chunk-1.sc.xz') == path
+    ## same name in another directory
+    assert sidecar_path('/geo', '/other/chunk-1.sc.xz') != path
+    with pytest.raises(ValueError):
+        sidecar_path('/geo', None)
+
+
+def test_place_coordinates():
+    anno = {'features': {'hierarchy': 'Geo.place.namedPlace',
+                         'place': {'latitude': 48.86667,
+                                   'longitude': 2.33333,
+                                   'geocoord': {'isValid': True}}}}
+    assert place_coordinates(anno) == (48.86667, 2.33333)
+    anno['features']['place']['geocoord']['isValid'] = False
+    assert place_coordinates(anno) is None
+    assert place_coordinates({'features': {'hierarchy': 'Person'}}) is None
+
+
+def test_geo_index_query(tmpdir):
+    path = str(tmpdir.join('geo', 'chunk.geo.jsonl'))
+    writer = GeoIndexWriter(path, cell_degrees=5.0)
+    writer.add(48.86667, 2.33333, 'paris', 0)
+    writer.add(31.25044, -99.25061, 'texas', 1)
+    ## visible to readers as soon as it is flushed
+    writer.flush()
+    assert len(list(GeoIndex(path).query(-90, -180, 90, 180))) == 2
+
+    writer.add(-17.7, 178.0, 'fiji', 2)
+    writer.add(-14.3, -170.7, 'samoa', 3)
+    assert len(writer) == 4
+    writer.close()
+
+    index = GeoIndex(path)
+    europe = list(index.query(south=40, west=-5, north=52, east=10))
+    assert europe == [('paris', 0, 48.86667, 2.33333)]
+
+    assert list(index.query(south=0, west=0, north=1, east=1)) == []
+
+    ## whole world, scanning every occupied cell
+    found = set(sid for sid, _, _, _ in index.query(-90, -180, 90, 180))
+    assert found == set(['paris', 'texas', 'fiji', 'samoa'])
+
+    ## crossing the antimeridian
+    pacific = set(sid for sid, _, _, _ in index.query(-20, 170, -10, -165))
+    assert pacific == set(['fiji', 'samoa'])
+
+
+def test_geo_index_empty_and_truncated(tmpdir):
+    path = str(tmpdir.join('chunk.geo.jsonl'))
+    GeoIndexWriter(path).close()
+    ## a chunk without places is indexed, just empty
+    assert list(GeoIndex(path).query(-90, -180, 90, 180)) == []
+
+    writer = GeoIndexWriter(path)
+    writer.add(48.86667, 2.33333, 'paris', 0)
+    writer.close()
+    with open(path, 'ab') as fh:
+        fh.write('[9,0,46.0,2.0,"fra')
+    assert [sid for sid, _, _, _ in GeoIndex(path).query(-90, -180, 90, 180)] \
+        == ['paris']
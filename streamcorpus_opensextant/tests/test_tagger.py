@@ -10,12 +10,16 @@ import sys
 
 
 import requests
-from streamcorpus import make_stream_item, Chunk, EntityType
+from streamcorpus import make_stream_item, Chunk, EntityType, \
+    RelationType, AttributeType, Language
 from streamcorpus_pipeline._tokenizer import nltk_tokenizer
 from streamcorpus_pipeline._clean_html import clean_html
 from streamcorpus_pipeline._clean_visible import clean_visible
 
-from streamcorpus_opensextant.tagger import OpenSextantTagger
+import streamcorpus_opensextant.tagger
+from streamcorpus_opensextant.geo_index import GeoIndex, sidecar_path
+from streamcorpus_opensextant.tagger import OpenSextantTagger, \
+    Mention, make_attributes
 
 logger = logging.getLogger('streamcorpus_pipeline.' + __name__)
 
@@ -120,7 +124,7 @@ def test_opensextant_tagger(text, tokens, json_path, use_live_service):
     ost = OpenSextantTagger(OpenSextantTagger.default_config)
     if not use_live_service:
         fpath = os.path.join(os.path.dirname(__file__), json_path)
-        ost.request_json = lambda si: DummyResponse(open(fpath).read())
+        ost.request_json = lambda si, rest_url=None, data=None: DummyResponse(open(fpath).read())
 
     tokenizer.process_item(si)
     ost.process_item(si)
@@ -132,7 +136,392 @@ def test_opensextant_tagger(text, tokens, json_path, use_live_service):
             assert tok.token.decode('utf8') == tokens[sent_idx][idx][0]
             assert tok.entity_type == tokens[sent_idx][idx][1]
 
-    
+
+
+def tag_offline(text, json_path, ost=None, context=None):
+    si = make_stream_item(10, 'fake_url')
+    si.body.clean_visible = text.encode('utf8')
+    nltk_tokenizer({}).process_item(si)
+    if ost is None:
+        ost = OpenSextantTagger(OpenSextantTagger.default_config)
+    fpath = os.path.join(os.path.dirname(__file__), json_path)
+    ost.request_json = lambda si, rest_url=None, data=None: DummyResponse(open(fpath).read())
+    ost.process_item(si, context)
+    return si
+
+
+def test_opensextant_ratings_and_labels():
+    text, _, json_path = texts[2]
+    si = tag_offline(text, json_path)
+
+    ratings = si.ratings['opensextant']
+    by_target = dict((r.target.target_id, r) for r in ratings)
+    ## both mentions of "Paris" resolve to the same gazetteer entry
+    assert by_target['opensextant:place:NGA-1456928'].mentions == ['Paris']
+    assert len(by_target) == len(ratings)
+
+    for sent in si.body.sentences['opensextant']:
+        for tok in sent.tokens:
+            if tok.entity_type is None:
+                assert 'opensextant' not in tok.labels
+            else:
+                labels = tok.labels['opensextant']
+                assert len(labels) == 1
+                assert labels[0].target.target_id in by_target
+
+
+def test_opensextant_relations():
+    text, _, json_path = texts[2]
+    si = tag_offline(text, json_path)
+
+    sents = si.body.sentences['opensextant']
+    def mention_text(sentence_id, mention_id):
+        return ' '.join(tok.token for tok in sents[sentence_id].tokens
+                        if tok.mention_id == mention_id)
+
+    pairs = [(mention_text(r.sentence_id_1, r.mention_id_1),
+              mention_text(r.sentence_id_2, r.mention_id_2))
+             for r in si.body.relations['opensextant']
+             if r.relation_type == RelationType.PARTWHOLE_Geographical]
+    assert sorted(pairs) == [('Paris,', 'France'),
+                             ('Paris,', 'Texas.'),
+                             ('Qu\xc3\xa9bec,', 'Canada.')]
+
+
+def test_make_attributes():
+    cv = u'Yesterday President Smith spoke.'
+    title = Mention(0, 0, 10, 19, 'Person.name.title.governmentTitle',
+                    {'matchText': u'President'})
+    person = Mention(1, 0, 20, 25, 'Person.name.personName',
+                     {'matchText': u'Smith'})
+    attrs = make_attributes([person, title], cv)
+    assert len(attrs) == 1
+    assert attrs[0].attribute_type == AttributeType.PER_TITLE
+    assert attrs[0].value == 'President'
+    assert attrs[0].mention_id == 1
+
+    ## a title on its own carries the attribute itself
+    attrs = make_attributes([title], cv)
+    assert attrs[0].mention_id == 0
+
+
+def test_opensextant_geo_index(tmpdir):
+    config = dict(OpenSextantTagger.default_config)
+    config['geo_index_dir'] = str(tmpdir)
+    ost = OpenSextantTagger(config)
+
+    text, _, json_path = texts[2]
+    si = tag_offline(text, json_path, ost, {'i_str': '/in/chunk-1.sc'})
+    ## the item's places are on disk as soon as it is tagged
+    index = GeoIndex(sidecar_path(str(tmpdir), '/in/chunk-1.sc'))
+    ## France, twice, but not Paris or anything in North America
+    found = list(index.query(south=40, west=-5, north=52, east=2.1))
+    assert len(found) == 2
+    assert set(stream_id for stream_id, _, _, _ in found) == \
+        set([si.stream_id])
+
+    ## a chunk whose items have no places still gets a sidecar
+    empty = make_stream_item(10, 'fake_url')
+    ost.process_item(empty, {'i_str': '/in/chunk-2.sc'})
+    index = GeoIndex(sidecar_path(str(tmpdir), '/in/chunk-2.sc'))
+    assert list(index.query(-90, -180, 90, 180)) == []
+
+    tag_offline(texts[0][0], texts[0][2], ost, {'i_str': '/in/chunk-3.sc'})
+    index = GeoIndex(sidecar_path(str(tmpdir), '/in/chunk-3.sc'))
+    assert len(list(index.query(-90, -180, 90, 180))) == 2
+
+    ## same name in another directory gets its own sidecar
+    tag_offline(text, json_path, ost, {'i_str': '/other/chunk-3.sc'})
+    index = GeoIndex(sidecar_path(str(tmpdir), '/in/chunk-3.sc'))
+    assert len(list(index.query(-90, -180, 90, 180))) == 2
+
+    ## without an input chunk the item is tagged but not indexed
+    before = sorted(os.listdir(str(tmpdir)))
+    si = tag_offline(text, json_path, ost)
+    assert 'opensextant' in si.body.taggings
+    assert sorted(os.listdir(str(tmpdir))) == before
+    assert len(before) == 4
+    ost.shutdown()
+    assert ost.geo_index is None
+
+def test_opensextant_route():
+    config = dict(OpenSextantTagger.default_config)
+    config.update({
+        'language_service_paths': {'EN': '/opensextant/extract/general/json',
+                                   'es': '/opensextant/extract/spanish/json',
+                                   'zh': None},
+        'min_clean_visible_bytes': 10,
+        'max_clean_visible_bytes': 1000,
+        'min_letter_fraction': 0.5,
+    })
+    ost = OpenSextantTagger(config)
+
+    def route(text, code=None):
+        si = make_stream_item(10, 'fake_url')
+        si.body.clean_visible = text
+        if code is not None:
+            si.body.language = Language(code=code, name='')
+        return ost.route(si)
+
+    text = 'Traveling to Paris, Texas.'
+    assert route(text, 'en') == \
+        'http://localhost:8182/opensextant/extract/general/json'
+    assert route(text, 'es') == \
+        'http://localhost:8182/opensextant/extract/spanish/json'
+    assert route(text) == ost.rest_url
+    assert route(text, 'zh') is None
+    assert route('Paris.', 'en') is None
+    assert route('Paris ' * 200, 'en') is None
+    assert route('\x00\x01\xff\xfe 1234 5678 abc', 'en') is None
+
+    ost.only_listed_languages = True
+    assert route(text, 'fr') is None
+
+    assert ost.route_counts == {
+        'sent:en': 1, 'sent:es': 1, 'sent:unknown': 1,
+        'skipped:language': 2, 'skipped:too_small': 1,
+        'skipped:too_large': 1, 'skipped:low_quality': 1,
+    }
+
+    ## skipped items pass through untagged
+    si = make_stream_item(10, 'fake_url')
+    si.body.clean_visible = 'Paris.'
+    assert ost.process_item(si) is si
+    assert 'opensextant' not in si.body.taggings
+
+
+class DummySession(object):
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.posts = []
+
+    def post(self, url, data=None, **kwargs):
+        self.posts.append((url, data))
+        self.kwargs = kwargs
+        if self.fail:
+            raise requests.ConnectionError('refused')
+        return DummyProbeResponse()
+
+
+class DummyProbeResponse(DummyResponse):
+    def __init__(self):
+        super(DummyProbeResponse, self).__init__('{"annoList": []}')
+
+    def raise_for_status(self):
+        pass
+
+
+class DummyAdapter(requests.adapters.BaseAdapter):
+    def __init__(self, fail=False):
+        super(DummyAdapter, self).__init__()
+        self.fail = fail
+        self.sent = []
+
+    def send(self, request, **kwargs):
+        self.sent.append((request.url, request.body))
+        if self.fail:
+            raise requests.ConnectionError('refused')
+        return DummyProbeResponse()
+
+    def close(self):
+        pass
+
+
+def test_opensextant_warm_up():
+    config = dict(OpenSextantTagger.default_config)
+    config['language_service_paths'] = {
+        'en': config['service_path'],
+        'es': '/opensextant/extract/spanish/json',
+        'zh': None,
+    }
+    ost = OpenSextantTagger(config)
+    ## nothing has touched the network or built a session yet
+    assert ost._session is None
+    assert not ost.warmed_up
+
+    adapter = DummyAdapter()
+    ost.session.mount(ost.base_url, adapter)
+    assert ost.warm_up(3)
+    assert ost.warmed_up
+    assert ost.warmup_seconds >= 0
+    spanish = ost.base_url + '/opensextant/extract/spanish/json'
+    assert sorted(adapter.sent) == sorted(
+        [(ost.rest_url, ost.warmup_text)] * 2 +
+        [(spanish, ost.warmup_text)])
+
+    ## every configured path is probed, even with fewer connections
+    adapter.sent = []
+    assert ost.warm_up(1)
+    assert sorted(url for url, _ in adapter.sent) == \
+        sorted([ost.rest_url, spanish])
+
+    ost = OpenSextantTagger(OpenSextantTagger.default_config)
+    ost.session.mount(ost.base_url, DummyAdapter(fail=True))
+    assert not ost.warm_up(2)
+    assert not ost.warmed_up
+    assert ost.warmup_seconds is None
+
+
+def test_opensextant_dedup(monkeypatch):
+    config = dict(OpenSextantTagger.default_config)
+    config.update({'dedup_window': 10, 'dedup_threshold': 0.5})
+    ost = OpenSextantTagger(config)
+
+    text, tokens, json_path = texts[2]
+    fpath = os.path.join(os.path.dirname(__file__), json_path)
+    sent = []
+    def request_json(si, rest_url=None, data=None):
+        sent.append(data)
+        if data == si.body.clean_visible:
+            return DummyResponse(open(fpath).read())
+        start = data.decode('utf8').find(u'Liberia')
+        return DummyResponse(json.dumps({'annoList': [{
+            'start': start, 'end': start + 7, 'matchText': u'Liberia',
+            'features': {'hierarchy': 'Geo.place.namedPlace'}}]}))
+    ost.request_json = request_json
+
+    def tag(text):
+        si = make_stream_item(10, 'fake_url')
+        si.body.clean_visible = text.encode('utf8')
+        nltk_tokenizer({}).process_item(si)
+        ost.process_item(si, {'i_str': 'chunk-1'})
+        return si
+
+    def entity_types(si):
+        return [[(tok.token.decode('utf8'), tok.entity_type)
+                 for tok in sent.tokens]
+                for sent in si.body.sentences['opensextant']]
+
+    first = tag(text)
+    copy = tag(text)
+    assert sent == [text.encode('utf8')]
+    assert entity_types(copy) == entity_types(first) == tokens
+    assert copy.body.taggings['opensextant'].raw_tagging == \
+        first.body.taggings['opensextant'].raw_tagging
+
+    assert first.body.taggings['opensextant'].tagger_version == '2.1'
+
+    near = tag(text + u'Shared by a reader in Liberia.\n')
+    assert len(sent) == 2
+    ## only the changed words were sent
+    assert sent[1] == 'Shared by a reader in Liberia.'
+    found = entity_types(near)
+    assert found[:-1] == tokens
+    assert found[-1][-1] == (u'Liberia.', EntityType.LOC)
+    tagging = near.body.taggings['opensextant']
+    assert tagging.tagger_version == '2.1-near-duplicate'
+    assert json.loads(tagging.raw_tagging)['nearDuplicateOf'] == \
+        first.stream_id
+
+    ## too much changed to be worth piecing together
+    ost.dedup_max_changed_fraction = 0.0
+    full = tag(text + u'Reposted from Liberia.\n')
+    assert sent[-1] == full.body.clean_visible
+    assert full.body.taggings['opensextant'].tagger_version == '2.1'
+
+    ## a near duplicate too big to diff is tagged whole without diffing
+    ost.dedup_max_changed_fraction = 0.5
+    ost.dedup_max_diff_bytes = 100
+    def diff_tokens(old_text, new_text):
+        raise AssertionError('diffed a body over dedup_max_diff_bytes')
+    monkeypatch.setattr(streamcorpus_opensextant.tagger, 'diff_tokens',
+                        diff_tokens)
+    big = tag(text + u'Quoted in Liberia.\n')
+    assert sent[-1] == big.body.clean_visible
+    assert big.body.taggings['opensextant'].tagger_version == '2.1'
+
+    ## bodies big enough to stream bypass the cache
+    ost.stream_threshold_bytes = 10
+    ost.request_json = lambda si, rest_url=None, data=None: \
+        StreamedResponse(open(fpath).read())
+    tag(text + u'Seen in Liberia.\n')
+
+    assert ost.dedup_counts == {'unique': 1, 'exact': 1, 'near': 1,
+                                'near_fallback': 2, 'too_large': 1}
+    assert len(ost.dedup_cache) == 4
+
+
+def test_opensextant_streaming_upload():
+    config = dict(OpenSextantTagger.default_config)
+    config.update({'stream_threshold_bytes': 20, 'stream_chunk_bytes': 8})
+    ost = OpenSextantTagger(config)
+    ost.session = DummySession()
+
+    si = make_stream_item(10, 'fake_url')
+    si.body.clean_visible = 'Paris.'
+    ost.request_json(si)
+    assert ost.session.posts[-1][1] is si.body.clean_visible
+    assert not ost.session.kwargs['stream']
+    assert ost.session.kwargs['timeout'] == 10
+
+    si.body.clean_visible = texts[2][0].encode('utf8')
+    ost.request_json(si)
+    chunks = list(ost.session.posts[-1][1])
+    assert all(isinstance(chunk, memoryview) for chunk in chunks)
+    assert max(len(chunk) for chunk in chunks) == 8
+    assert ''.join(chunk.tobytes() for chunk in chunks) == \
+        si.body.clean_visible
+    assert ost.session.kwargs['stream']
+    ## streamed bodies get more time to be tagged
+    assert ost.session.kwargs['timeout'] == \
+        10 + 10 * len(si.body.clean_visible) / float(2**20)
+
+    ost.stream_timeout_per_mb = 60
+    si.body.clean_visible = 'x' * 2**21
+    ost.request_json(si)
+    assert ost.session.kwargs['timeout'] == 130
+
+
+class StreamedResponse(object):
+    '''Response that can only be read piece by piece.'''
+    def __init__(self, body):
+        self.body = body
+        self.pieces = 0
+
+    @property
+    def content(self):
+        raise AssertionError('streamed response buffered in full')
+
+    def iter_content(self, chunk_size):
+        for start in xrange(0, len(self.body), chunk_size):
+            self.pieces += 1
+            yield self.body[start:start + chunk_size]
+
+
+def test_opensextant_streaming_response():
+    config = dict(OpenSextantTagger.default_config)
+    config.update({'stream_threshold_bytes': 20, 'stream_chunk_bytes': 64})
+    ost = OpenSextantTagger(config)
+
+    text, tokens, json_path = texts[2]
+    fpath = os.path.join(os.path.dirname(__file__), json_path)
+    body = open(fpath).read()
+    response = StreamedResponse(body)
+    ost.request_json = lambda si, rest_url=None, data=None: response
+
+    parsed = []
+    annotate_sentences = ost.annotate_sentences
+    def spy(si, result):
+        parsed.append(result)
+        return annotate_sentences(si, result)
+    ost.annotate_sentences = spy
+
+    si = make_stream_item(10, 'fake_url')
+    si.body.clean_visible = text.encode('utf8')
+    nltk_tokenizer({}).process_item(si)
+    ost.process_item(si)
+
+    ## read in pieces into raw_tagging, never through .content
+    assert response.pieces == (len(body) + 63) // 64
+    assert si.body.taggings['opensextant'].raw_tagging == body
+    ## the echoed document is not kept alongside the raw bytes
+    assert 'content' in json.loads(body)
+    assert 'content' not in parsed[0]
+    assert [[tok.entity_type for tok in sent.tokens]
+            for sent in si.body.sentences['opensextant']] == \
+        [[etype for _, etype in sent] for sent in tokens]
+
+
 def main():
     logging.basicConfig(level=logging.DEBUG)
 